@@ -10,10 +10,21 @@ from typing import Union
 import json
 import os
 import pickle
+import threading
+import time
 
 
 class LinearRegressor:
-    def __init__(self, src_data: dict = None):
+    def __init__(self, src_data: dict = None, batch_size: int = None, batch_time: float = None,
+                 async_updates: bool = False):
+        """
+        :param src_data: dictionary of a previously saved regressor.
+        :param batch_size: number of learning steps to collect before the weights are updated,
+                           None for no limit on the count (only batch_time flushes).
+        :param batch_time: seconds after the first collected step at which the weights are updated regardless,
+                           None for no time limit. With neither set, the weights are updated on every step.
+        :param async_updates: apply the collected updates in a background thread.
+        """
         # prep handlers for input values ---------------------------
         self.states = {'input': StateSpace(),
                        'old_input': StateSpace(),
@@ -35,6 +46,15 @@ class LinearRegressor:
 
         self.step = 'state output'
 
+        # prep handlers for deferred weight updates ---------------------------
+        self.batch_size = None if batch_size is None else max(int(batch_size), 1)
+        self.batch_time = batch_time
+        self.async_updates = async_updates
+        self._pending = []
+        self._pending_start = None
+        self._update_thread = None
+        self._weights_lock = threading.RLock()
+
         if src_data is not None:
             self._overwrite_from_dict(src_data=src_data)
         return
@@ -179,48 +199,143 @@ class LinearRegressor:
         self.rewards['error']['Logic Error'] = -np.abs(pure_logic_error.magnitude())
         return
 
-    def _determine_value_weights(self) -> None:
+    def _determine_value_weights(self, old_input: StateSpace = None, reward_error: StateSpace = None,
+                                 weights: dict = None) -> None:
         """
         To be run after updating the input state and reward error.
 
         This function is responsible for expanding partial_value_errors and value_weights to match provided rewards.
+        :param old_input: input state the errors belong to, defaults to the current old input state.
+        :param reward_error: reward errors to learn from, defaults to the current reward errors.
+        :param weights: value weights to add the changes to, defaults to the regressor's value weights.
         :return:
         """
-
-        for rwd_type, rwd_err_val in self.rewards['error'].items():
-            if rwd_type not in self.weights['EV'].keys():
-                self.weights['EV'][rwd_type] = StateSpace()
-
-            for ky1, val1 in self.states['old_input'].items():
-                if ky1 not in self.weights['EV'][rwd_type].keys():
-                    self.weights['EV'][rwd_type][ky1] = StateSpace()
-
-                for ky2, val2 in self.states['old_input'].items():
-                    if ky2 in self.weights['EV'][rwd_type][ky1].keys():
-                        self.weights['EV'][rwd_type][ky1][ky2] += val1.inverse() | rwd_err_val | val2
+        if old_input is None:
+            old_input = self.states['old_input']
+        if reward_error is None:
+            reward_error = self.rewards['error']
+        if weights is None:
+            weights = self.weights['EV']
+
+        for rwd_type, rwd_err_val in reward_error.items():
+            if rwd_type not in weights.keys():
+                weights[rwd_type] = StateSpace()
+
+            for ky1, val1 in old_input.items():
+                if ky1 not in weights[rwd_type].keys():
+                    weights[rwd_type][ky1] = StateSpace()
+
+                for ky2, val2 in old_input.items():
+                    if ky2 in weights[rwd_type][ky1].keys():
+                        weights[rwd_type][ky1][ky2] += val1.inverse() | rwd_err_val | val2
                     else:
-                        self.weights['EV'][rwd_type][ky1][ky2] = val1.inverse() | rwd_err_val | val2
+                        weights[rwd_type][ky1][ky2] = val1.inverse() | rwd_err_val | val2
 
         return
 
-    def _determine_stimulus_weights(self) -> None:
+    def _determine_stimulus_weights(self, old_input: StateSpace = None, state_error: Geo = None,
+                                    weights: dict = None) -> None:
         """
         To be run after updating the input state and stimulus error.
 
         This function is responsible for expanding partial_stimuli_errors and stimuli_weights to match provided rewards.
+        :param old_input: input state the error belongs to, defaults to the current old input state.
+        :param state_error: stimulus error to learn from, defaults to the current stimulus error.
+        :param weights: stimulus weights to add the changes to, defaults to the regressor's stimulus weights.
         :return:
         """
+        if old_input is None:
+            old_input = self.states['old_input']
+        if state_error is None:
+            state_error = self.states['error']
+        if weights is None:
+            weights = self.weights['stimuli']
+
+        for ky1, val1 in old_input.items():
+            if ky1 not in weights.keys():
+                weights[ky1] = StateSpace()
+
+            for ky2, val2 in old_input.items():
+                if ky2 in weights[ky1].keys():
+                    weights[ky1][ky2] += val1.inverse() | state_error | val2
+                else:
+                    weights[ky1][ky2] = val1.inverse() | state_error | val2
 
-        for ky1, val1 in self.states['old_input'].items():
-            if ky1 not in self.weights['stimuli'].keys():
-                self.weights['stimuli'][ky1] = StateSpace()
+        return
 
-            for ky2, val2 in self.states['old_input'].items():
-                if ky2 in self.weights['stimuli'][ky1].keys():
-                    self.weights['stimuli'][ky1][ky2] += val1.inverse() | self.states['error'] | val2
+    @staticmethod
+    def _merge_weights(weights, deltas) -> None:
+        """
+        Add a 2D map of summed weight changes to a 2D weight map, one in-place addition per weight.
+        :param weights:
+        :param deltas:
+        :return:
+        """
+        for ky1, row in deltas.items():
+            if ky1 not in weights.keys():
+                weights[ky1] = StateSpace()
+
+            for ky2, val in row.items():
+                if ky2 in weights[ky1].keys():
+                    weights[ky1][ky2] += val
                 else:
-                    self.weights['stimuli'][ky1][ky2] = val1.inverse() | self.states['error'] | val2
+                    weights[ky1][ky2] = val
+        return
+
+    def _apply_pending(self, pending: list, background: bool = False) -> None:
+        """
+        Sum the weight changes of every collected (old_input, reward_error, state_error) into private maps, then
+        merge them into the weights. The weights lock is only held for the merge, so the forward pass can keep
+        running while the changes are summed.
+        :param pending:
+        :param background: yield to the forward pass between collected steps.
+        :return:
+        """
+        deltas = {'stimuli': {},
+                  'EV': {}}
+        for old_input, reward_error, state_error in pending:
+            self._determine_value_weights(old_input=old_input, reward_error=reward_error, weights=deltas['EV'])
+            self._determine_stimulus_weights(old_input=old_input, state_error=state_error, weights=deltas['stimuli'])
+            if background:
+                time.sleep(0)
+
+        with self._weights_lock:
+            self._merge_weights(self.weights['stimuli'], deltas['stimuli'])
+            for rwd_type, rwd_deltas in deltas['EV'].items():
+                if rwd_type not in self.weights['EV'].keys():
+                    self.weights['EV'][rwd_type] = StateSpace()
+                self._merge_weights(self.weights['EV'][rwd_type], rwd_deltas)
+        return
+
+    def apply_updates(self, wait: bool = False) -> None:
+        """
+        Apply all collected learning steps to the weights in one pass.
+        :param wait: block until the weights are updated, even if async_updates is set.
+        :return:
+        """
+        self.wait_for_updates()
+        if not self._pending:
+            return
+
+        pending = self._pending
+        self._pending = []
+        self._pending_start = None
 
+        if self.async_updates and not wait:
+            self._update_thread = threading.Thread(target=self._apply_pending, args=(pending, True), daemon=True)
+            self._update_thread.start()
+        else:
+            self._apply_pending(pending)
+        return
+
+    def wait_for_updates(self) -> None:
+        """
+        Block until a weight update running in the background is done.
+        :return:
+        """
+        if self._update_thread is not None:
+            self._update_thread.join()
+            self._update_thread = None
         return
 
     def process_activity(self):
@@ -233,8 +348,9 @@ class LinearRegressor:
         Use V(C|I) to get the probability of activation P(C|I) and activation 'C'
         :return:
         """
-        self._determine_stimulus()
-        self._determine_expected_values()
+        with self._weights_lock:
+            self._determine_stimulus()
+            self._determine_expected_values()
 
         self._determine_activation()
         self._determine_reward_emission()
@@ -244,13 +360,28 @@ class LinearRegressor:
     def process_learning(self):
         """
         Process the errors and adjust the weights.
+
+        With a batch_size above 1 and/or a batch_time, the errors are collected and the weights are only adjusted
+        once batch_size steps are collected or batch_time has run out, whichever comes first (see apply_updates).
         :return:
         """
         self._determine_value_error()
         self._determine_stimulus_error()
 
-        self._determine_value_weights()
-        self._determine_stimulus_weights()
+        if self.batch_size in (None, 1) and self.batch_time is None:
+            with self._weights_lock:
+                self._determine_value_weights()
+                self._determine_stimulus_weights()
+        else:
+            if self._pending_start is None:
+                self._pending_start = time.perf_counter()
+            self._pending.append((self.states['old_input'].copy(),
+                                  self.rewards['error'].copy(),
+                                  self.states['error'].copy()))
+
+            if (self.batch_size is not None and len(self._pending) >= self.batch_size) or \
+                    (self.batch_time is not None and time.perf_counter() - self._pending_start >= self.batch_time):
+                self.apply_updates()
         self.step = 'Backwards Processing'
         return
 
@@ -268,7 +399,10 @@ class LinearRegressor:
         nrn_dict = {'states': self.states,
                     'rewards': self.rewards,
                     'weights': self.weights,
-                    'step': self.step}
+                    'step': self.step,
+                    'batch': {'batch_size': self.batch_size,
+                              'batch_time': self.batch_time,
+                              'async_updates': self.async_updates}}
         return nrn_dict
 
     def _overwrite_from_dict(self, src_data: dict):
@@ -295,12 +429,18 @@ class LinearRegressor:
                                 self.weights[ky1][ky2][ky3] = StateSpace(val1)
             elif ky == 'step':
                 self.step = src_data[ky]
+            elif ky == 'batch':
+                batch_size = src_data[ky].get('batch_size', self.batch_size)
+                self.batch_size = None if batch_size is None else max(int(batch_size), 1)
+                self.batch_time = src_data[ky].get('batch_time', self.batch_time)
+                self.async_updates = src_data[ky].get('async_updates', self.async_updates)
         return
 
     def __str__(self):
         return json.dumps(self.__dict__(), sort_keys=True, ensure_ascii=False, indent=4)
 
     def __reduce_ex__(self, protocol):
+        self.apply_updates(wait=True)
         return self.__class__, (self.__dict__(),)
 
     def __repr__(self) -> str:
@@ -327,6 +467,7 @@ class LinearRegressor:
         return to_return
 
     def save(self, src_path='.', name='state', as_json=False) -> None:
+        self.apply_updates(wait=True)
         if not os.path.exists(src_path):
             os.makedirs(src_path, exist_ok=True)
 
@@ -346,6 +487,249 @@ class LinearRegressor:
         file_path = f'{src_path}/{name}.pkl'
         if os.path.exists(file_path):
             with open(file_path, "rb") as a_file:
-                self._overwrite_from_dict(pickle.load(a_file))
+                src_data = pickle.load(a_file)
+            # drop updates learned before the load, they do not belong to the loaded weights
+            self.wait_for_updates()
+            self._pending = []
+            self._pending_start = None
+            self._overwrite_from_dict(src_data)
             return True
         return False
+
+
+class LowRankFactors:
+    """
+    Rank-k factorization W ~= U * diag(s) * V^T of a pairwise weight matrix over an ordered set of input keys.
+    """
+    def __init__(self, rank: int, src_data: dict = None):
+        self.rank = max(int(rank), 1)
+        self.index = {}
+        self.u = np.zeros((0, 0), dtype=complex)
+        self.s = np.zeros(0, dtype=complex)
+        self.v = np.zeros((0, 0), dtype=complex)
+
+        if src_data is not None:
+            self.rank = src_data.get('rank', self.rank)
+            self.index = {ky: ind for ind, ky in enumerate(src_data.get('keys', []))}
+            self.s = np.array(src_data.get('s', self.s), dtype=complex)
+            self.u = np.array(src_data.get('u', self.u), dtype=complex).reshape(len(self.index), len(self.s))
+            self.v = np.array(src_data.get('v', self.v), dtype=complex).reshape(len(self.index), len(self.s))
+        return
+
+    def expand(self, keys) -> None:
+        """
+        Add zero rows for input keys that have not been seen before.
+        :param keys:
+        :return:
+        """
+        new_keys = [ky for ky in keys if ky not in self.index]
+        if new_keys:
+            for ky in new_keys:
+                self.index[ky] = len(self.index)
+            pad = ((0, len(new_keys)), (0, 0))
+            self.u = np.pad(self.u, pad)
+            self.v = np.pad(self.v, pad)
+        return
+
+    def vector(self, values: dict) -> np.ndarray:
+        vec = np.zeros(len(self.index), dtype=complex)
+        for ky, val in values.items():
+            vec[self.index[ky]] = val
+        return vec
+
+    def evaluate(self, left: np.ndarray, right: np.ndarray) -> complex:
+        """
+        left^T * W * right in O(n*k)
+        """
+        return complex(((left @ self.u) * self.s) @ (self.v.T @ right))
+
+    def add_outer(self, left: np.ndarray, right: np.ndarray) -> None:
+        """
+        W += left * right^T, truncated back to the rank in O(n*k^2).
+        """
+        q_u, r_u = np.linalg.qr(np.column_stack([self.u, left]))
+        q_v, r_v = np.linalg.qr(np.column_stack([self.v, right]))
+        core = r_u @ np.diag(np.append(self.s, 1.0)) @ r_v.T
+        c_u, c_s, c_vh = np.linalg.svd(core)
+        k = min(self.rank, len(c_s))
+        self.u = q_u @ c_u[:, :k]
+        self.s = c_s[:k].astype(complex)
+        self.v = q_v @ c_vh[:k, :].T
+        return
+
+    def to_dense(self) -> np.ndarray:
+        return (self.u * self.s) @ self.v.T
+
+    def __dict__(self):
+        return {'rank': self.rank,
+                'keys': list(self.index.keys()),
+                'u': self.u,
+                's': self.s,
+                'v': self.v}
+
+    def to_json(self):
+        to_return = {'rank': self.rank, 'keys': list(self.index.keys())}
+        for ky in ('u', 's', 'v'):
+            to_return[ky] = {'real': getattr(self, ky).real.tolist(), 'imag': getattr(self, ky).imag.tolist()}
+        return to_return
+
+
+class LowRankRegressor(LinearRegressor):
+    """
+    Approximate LinearRegressor keeping a rank-k factorization of each pairwise weight matrix.
+
+    Only the scalar ('+0') part of the inputs and errors is used, so a weight is a number instead of a Geo and
+    stimulus = x^T * W * (1/x) costs O(n*k) instead of O(n^2). Use compare_to_exact to measure the accuracy lost.
+    """
+    def __init__(self, src_data: dict = None, rank: int = 4, **kwargs):
+        self.rank = rank
+        self.factors = {'stimuli': LowRankFactors(rank=rank),
+                        'EV': {}}
+        super().__init__(src_data=src_data, **kwargs)
+        return
+
+    @staticmethod
+    def _scalar(val) -> complex:
+        if isinstance(val, (Geo,)):
+            return val['+0']
+        return val
+
+    def _input_vectors(self, factors: LowRankFactors, states: StateSpace) -> (np.ndarray, np.ndarray):
+        factors.expand(states.keys())
+        values = {ky: self._scalar(val) for ky, val in states.items()}
+        left = factors.vector(values)
+        right = np.zeros_like(left)
+        nonzero = left != 0
+        right[nonzero] = 1.0 / left[nonzero]
+        return left, right
+
+    # Internal handlers ------------------------
+    def _determine_stimulus(self) -> None:
+        left, right = self._input_vectors(self.factors['stimuli'], self.states['input'])
+        self.states['stimuli'] = Geo({'+0': self.factors['stimuli'].evaluate(left, right)})
+        return
+
+    def _determine_expected_values(self) -> None:
+        self.rewards['EV'].empty()
+
+        for rwd_type, rwd_factors in self.factors['EV'].items():
+            left, right = self._input_vectors(rwd_factors, self.states['input'])
+            self.rewards['EV'][rwd_type] = Geo({'+0': rwd_factors.evaluate(left, right)})
+        return
+
+    def _determine_value_weights(self, old_input: StateSpace = None, reward_error: StateSpace = None) -> None:
+        if old_input is None:
+            old_input = self.states['old_input']
+        if reward_error is None:
+            reward_error = self.rewards['error']
+
+        for rwd_type, rwd_err_val in reward_error.items():
+            if rwd_type not in self.factors['EV'].keys():
+                self.factors['EV'][rwd_type] = LowRankFactors(rank=self.rank)
+
+            left, right = self._input_vectors(self.factors['EV'][rwd_type], old_input)
+            self.factors['EV'][rwd_type].add_outer(right * self._scalar(rwd_err_val), left)
+        return
+
+    def _determine_stimulus_weights(self, old_input: StateSpace = None, state_error: Geo = None) -> None:
+        if old_input is None:
+            old_input = self.states['old_input']
+        if state_error is None:
+            state_error = self.states['error']
+
+        left, right = self._input_vectors(self.factors['stimuli'], old_input)
+        self.factors['stimuli'].add_outer(right * self._scalar(state_error), left)
+        return
+
+    def _apply_pending(self, pending: list, background: bool = False) -> None:
+        """
+        Factor updates are cheap, so apply the collected steps one by one, holding the weights lock per step only.
+        :param pending:
+        :param background: yield to the forward pass between collected steps.
+        :return:
+        """
+        for old_input, reward_error, state_error in pending:
+            with self._weights_lock:
+                self._determine_value_weights(old_input=old_input, reward_error=reward_error)
+                self._determine_stimulus_weights(old_input=old_input, state_error=state_error)
+            if background:
+                time.sleep(0)
+        return
+
+    # ---- conversion methods -----
+    def __dict__(self):
+        nrn_dict = super().__dict__()
+        nrn_dict['rank'] = self.rank
+        nrn_dict['factors'] = {'stimuli': self.factors['stimuli'].__dict__(),
+                               'EV': {ky: val.__dict__() for ky, val in self.factors['EV'].items()}}
+        return nrn_dict
+
+    def to_json(self):
+        to_return = super().to_json()
+        to_return['factors'] = {'stimuli': self.factors['stimuli'].to_json(),
+                                'EV': {ky: val.to_json() for ky, val in self.factors['EV'].items()}}
+        return to_return
+
+    def _overwrite_from_dict(self, src_data: dict):
+        super()._overwrite_from_dict(src_data={ky: val for ky, val in src_data.items() if ky != 'weights'})
+        self.rank = src_data.get('rank', self.rank)
+        if 'factors' in src_data:
+            self.factors['stimuli'] = LowRankFactors(rank=self.rank, src_data=src_data['factors']['stimuli'])
+            self.factors['EV'] = {ky: LowRankFactors(rank=self.rank, src_data=val)
+                                  for ky, val in src_data['factors']['EV'].items()}
+        return
+
+
+def _relative_error(approx, exact) -> float:
+    """
+    Magnitude of the full Geo difference relative to the magnitude of the exact value.
+    """
+    approx = convert_to_geo(approx) if not isinstance(approx, (Geo,)) else approx
+    exact = convert_to_geo(exact) if not isinstance(exact, (Geo,)) else exact
+    return float(np.abs((approx - exact).magnitude()) / max(np.abs(exact.magnitude()), sys.float_info.epsilon))
+
+
+def compare_to_exact(records: list, rank: int = 4, seed: int = 0) -> dict:
+    """
+    Replay recorded data through a LinearRegressor and a LowRankRegressor and measure how far the approximation is off.
+
+    Both regressors draw the same random numbers for their activation, so differences only come from the weights.
+    The error is measured over all blades, so it includes the blades the low-rank mode does not model.
+    The global numpy random state is restored afterwards.
+    :param records: list of (states, rewards) per time step, rewards may be None.
+    :param rank: rank of the approximation.
+    :param seed: seed for the activation random numbers.
+    :return: mean and max relative error of the stimulus and expected values
+    """
+    exact = LinearRegressor()
+    approx = LowRankRegressor(rank=rank)
+    global_rndm_state = np.random.get_state()
+    try:
+        np.random.seed(seed)
+
+        stimulus_errors = []
+        ev_errors = []
+        for states, rewards in records:
+            for nrn in (exact, approx):
+                nrn.input_states(states)
+            rndm_state = np.random.get_state()
+            exact.process_activity()
+            np.random.set_state(rndm_state)
+            approx.process_activity()
+
+            stimulus_errors.append(_relative_error(approx.states['stimuli'], exact.states['stimuli']))
+
+            for rwd_type, rwd_val in exact.rewards['EV'].items():
+                ev_errors.append(_relative_error(approx.rewards['EV'].get(rwd_type, Geo()), rwd_val))
+
+            if rewards is not None:
+                for nrn in (exact, approx):
+                    nrn.input_rewards(StateSpace(rewards))
+                    nrn.process_learning()
+    finally:
+        np.random.set_state(global_rndm_state)
+
+    return {'stimulus': {'mean': float(np.mean(stimulus_errors)) if stimulus_errors else 0.0,
+                         'max': float(np.max(stimulus_errors)) if stimulus_errors else 0.0},
+            'EV': {'mean': float(np.mean(ev_errors)) if ev_errors else 0.0,
+                   'max': float(np.max(ev_errors)) if ev_errors else 0.0}}
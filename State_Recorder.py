@@ -7,16 +7,30 @@ from dataclasses import dataclass
 import json
 import pickle
 import glob
+import time
+import struct
+import sys
+import numbers
+import weakref
+import tempfile
+import itertools
 import numpy as np
 from copy import deepcopy
+from multiprocessing import shared_memory, resource_tracker
 
 """
 StateDict dataclass allows a flat dictionary to be used, loaded and saved
 
+save_checkpoint: write a flat dictionary as a binary checkpoint with its numbers and Geo blades in contiguous buffers
+load_checkpoint: read a binary checkpoint back into a flat dictionary
+benchmark_checkpoint: time the binary checkpoint against the plain pickle file for a given state
+
 save_array: take an iterable nD array and save it to the target path
 load_array: load an iterable nD array from a target path
 
 Binary storage is for speed and memory efficiency, while json is for human readability.
+
+SharedStateSpace: hand a StateSpace with a fixed key schema between processes through shared memory
 """
 
 
@@ -117,6 +131,13 @@ class StateSpace:
         return to_return
 
     def load(self, src_path='.', name='state') -> bool:
+        """
+        Load the binary checkpoint if there is one, else fall back to the older pickle file.
+        """
+        file_path = f'{src_path}/{name}.ckpt'
+        if os.path.exists(file_path):
+            self.__set = load_checkpoint(file_path)
+            return True
 
         file_path = f'{src_path}/{name}.pkl'
         if os.path.exists(file_path):
@@ -129,10 +150,8 @@ class StateSpace:
         if not os.path.exists(src_path):
             os.makedirs(src_path, exist_ok=True)
 
-        file_path = f'{src_path}/{name}.pkl'
-
-        with open(file_path, "wb") as a_file:
-            pickle.dump(self.__set, a_file)
+        file_path = f'{src_path}/{name}.ckpt'
+        save_checkpoint(self.__set, file_path)
 
         if as_json:
             file_path = f'{src_path}/{name}.json'
@@ -211,6 +230,485 @@ def del_saves(src_path='.', name='state'):
                 print('Failed to delete %s. Reason: %s' % (filename, e))
     return
 
+
+# binary checkpoints -----------------------------------
+_checkpoint_magic = b'SSCKPT01'
+_checkpoint_align = 64
+
+
+_checkpoint_dtypes = {float: np.float64, complex: np.complex128, int: np.int64}
+
+
+def _pad_to(size: int, align: int = _checkpoint_align) -> int:
+    return -size % align
+
+
+def _buffer_type(values: list):
+    """
+    Python type shared by all values if they can be stored in a buffer and come back unchanged, else None.
+    """
+    if not values:
+        return None
+    val_type = type(values[0])
+    if val_type not in _checkpoint_dtypes or any(type(val) is not val_type for val in values):
+        return None
+    if val_type is int and any(not -2 ** 63 <= val < 2 ** 63 for val in values):
+        return None
+    return val_type
+
+
+def save_checkpoint(src: dict, file_path: str) -> None:
+    """
+    Write a flat dictionary as a binary checkpoint.
+
+    Plain float, complex and int values are gathered into one contiguous array per type. Geo values whose blades all
+    share one of these types are grouped by blade layout and type into one 2D array (Geo x blade) per group. Everything else (numpy scalars, mixed or non-numeric Geo blades, ...)
+    is kept as is. The whole is pickled with protocol 5 so the arrays (including any numpy array values) are written
+    out-of-band as raw, aligned buffers.
+    The file is written to a temporary sibling first and renamed, so a checkpoint is never left half written.
+
+    File layout: [magic][meta length uint64][meta pickle][buffer count uint64]
+                 ([buffer length uint64][padding][buffer bytes]) * buffer count
+    :param src:
+    :param file_path:
+    :return:
+    """
+    plain_values = {val_type: ([], []) for val_type in _checkpoint_dtypes}
+    geos = {}
+    other = {}
+    for ky, val in src.items():
+        if isinstance(val, (Geo,)):
+            blades = list(val.keys())
+            blade_vals = [val[blade] for blade in blades]
+            val_type = _buffer_type(blade_vals)
+            if val_type is None:
+                other[ky] = val
+                continue
+            geo_keys, geo_vals = geos.setdefault((val_type, tuple(blades)), ([], []))
+            geo_keys.append(ky)
+            geo_vals.append(blade_vals)
+        elif _buffer_type([val]) is not None:
+            number_keys, number_vals = plain_values[type(val)]
+            number_keys.append(ky)
+            number_vals.append(val)
+        else:
+            other[ky] = val
+
+    meta = {'order': list(src.keys()),
+            'numbers': [(number_keys, np.asarray(number_vals, dtype=_checkpoint_dtypes[val_type]))
+                        for val_type, (number_keys, number_vals) in plain_values.items() if number_keys],
+            'geo': [(blades, geo_keys, np.asarray(geo_vals, dtype=_checkpoint_dtypes[val_type]))
+                    for (val_type, blades), (geo_keys, geo_vals) in geos.items()],
+            'other': other}
+
+    buffers = []
+    meta_bytes = pickle.dumps(meta, protocol=5, buffer_callback=buffers.append)
+
+    # unique temporary name so concurrent saves of the same state do not collide, prefixed with the file name so
+    # del_saves also removes a leftover one
+    tmp_fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.',
+                                        prefix=f'{os.path.basename(file_path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(tmp_fd, 'wb') as a_file:
+            a_file.write(_checkpoint_magic)
+            a_file.write(struct.pack('<Q', len(meta_bytes)))
+            a_file.write(meta_bytes)
+            a_file.write(struct.pack('<Q', len(buffers)))
+            for buffer in buffers:
+                raw = buffer.raw()
+                a_file.write(struct.pack('<Q', raw.nbytes))
+                a_file.write(b'\0' * _pad_to(a_file.tell()))
+                a_file.write(raw)
+            a_file.flush()
+            os.fsync(a_file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return
+
+
+def load_checkpoint(file_path: str) -> dict:
+    """
+    Read a binary checkpoint written by save_checkpoint.
+
+    The file is read in one go and the out-of-band buffers are handed to pickle as views of it, so the arrays are not
+    copied again while unpickling. Numpy array values stay views of the file data. Geo values are kept as rows of
+    their group's array and only built once they are accessed (see CheckpointValues).
+    :param file_path:
+    :return:
+    """
+    with open(file_path, 'rb') as a_file:
+        data = bytearray(os.fstat(a_file.fileno()).st_size)
+        a_file.readinto(data)
+    view = memoryview(data)
+
+    if bytes(view[:len(_checkpoint_magic)]) != _checkpoint_magic:
+        raise ValueError(f'{file_path} is not a StateSpace checkpoint.')
+    pos = len(_checkpoint_magic)
+    meta_len, = struct.unpack_from('<Q', view, pos)
+    pos += 8
+    meta_bytes = view[pos:pos + meta_len]
+    pos += meta_len
+    buffer_count, = struct.unpack_from('<Q', view, pos)
+    pos += 8
+    buffers = []
+    for _ in range(buffer_count):
+        buffer_len, = struct.unpack_from('<Q', view, pos)
+        pos += 8
+        pos += _pad_to(pos)
+        buffers.append(view[pos:pos + buffer_len])
+        pos += buffer_len
+
+    meta = pickle.loads(meta_bytes, buffers=buffers)
+
+    loaded = CheckpointValues(dict.fromkeys(meta['order'], _unloaded))
+    dict.update(loaded, meta['other'])
+    for number_keys, number_vals in meta['numbers']:
+        dict.update(loaded, zip(number_keys, number_vals.tolist()))
+
+    for blades, geo_keys, geo_vals in meta['geo']:
+        loaded.lazy.update(zip(geo_keys, zip(itertools.repeat((blades, geo_vals)), range(len(geo_keys)))))
+    return loaded
+
+
+_unloaded = object()
+
+
+class CheckpointValues(dict):
+    """
+    Dictionary loaded from a binary checkpoint, building its Geo values from the checkpoint arrays on first access.
+
+    Only the dictionary methods StateSpace uses are made aware of the unbuilt values, items, values and copy build
+    all remaining values at once.
+    """
+    def __init__(self, src: dict = None):
+        super().__init__(src if src is not None else {})
+        self.lazy = {}
+
+    def _build(self, key):
+        (blades, geo_vals), ind = self.lazy.pop(key)
+        val = Geo(dict(zip(blades, geo_vals[ind].tolist())))
+        dict.__setitem__(self, key, val)
+        return val
+
+    def _build_all(self) -> None:
+        group_rows = {}
+        for key, ((blades, geo_vals), ind) in self.lazy.items():
+            rows = group_rows.get(id(geo_vals))
+            if rows is None:
+                rows = group_rows[id(geo_vals)] = geo_vals.tolist()
+            dict.__setitem__(self, key, Geo(dict(zip(blades, rows[ind]))))
+        self.lazy.clear()
+        return
+
+    def __getitem__(self, key):
+        if key in self.lazy:
+            return self._build(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self.lazy.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.lazy.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self, key, *default):
+        if key in self.lazy:
+            self._build(key)
+        return dict.pop(self, key, *default)
+
+    def items(self):
+        self._build_all()
+        return dict.items(self)
+
+    def values(self):
+        self._build_all()
+        return dict.values(self)
+
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def copy(self) -> dict:
+        self._build_all()
+        return dict(dict.items(self))
+
+    def __reduce_ex__(self, protocol):
+        return dict, (self.copy(),)
+
+
+def benchmark_checkpoint(src: Union[dict, StateSpace], src_path='.', name='benchmark', repeat=5) -> dict:
+    """
+    Time saving and loading a state as a binary checkpoint against the plain pickle file StateSpace used before.
+
+    Run it on a recorded state of the real size, the balance depends on how many values are Geo values, since those
+    are built lazily after the checkpoint is loaded.
+    The checkpoint save time includes its fsync and rename, the pickle save time does not.
+    :param src: state to save and load.
+    :param src_path: directory for the temporary files, they are deleted afterwards.
+    :param name:
+    :param repeat: number of runs, the fastest is reported.
+    :return: best save and load time in seconds for 'ckpt' and 'pkl', plus 'load_all' for 'ckpt' with every lazy
+             Geo value built
+    """
+    if not os.path.exists(src_path):
+        os.makedirs(src_path, exist_ok=True)
+    values = dict(src.items())
+    timings = {'ckpt': {'save': [], 'load': [], 'load_all': []},
+               'pkl': {'save': [], 'load': []}}
+
+    try:
+        for _ in range(repeat):
+            file_path = f'{src_path}/{name}.ckpt'
+            start = time.perf_counter()
+            save_checkpoint(values, file_path)
+            timings['ckpt']['save'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            loaded = load_checkpoint(file_path)
+            timings['ckpt']['load'].append(time.perf_counter() - start)
+            loaded.items()
+            timings['ckpt']['load_all'].append(time.perf_counter() - start)
+
+            file_path = f'{src_path}/{name}.pkl'
+            start = time.perf_counter()
+            with open(file_path, "wb") as a_file:
+                pickle.dump(values, a_file)
+            timings['pkl']['save'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            with open(file_path, "rb") as a_file:
+                pickle.load(a_file)
+            timings['pkl']['load'].append(time.perf_counter() - start)
+    finally:
+        del_saves(src_path=src_path, name=name)
+
+    return {fmt: {step: min(times) for step, times in fmt_times.items()} for fmt, fmt_times in timings.items()}
+
+
+# shared memory transport -----------------------------------
+class SharedStateSpace:
+    """
+    Place the values of a StateSpace into a multiprocessing shared memory segment.
+
+    The key schema is taken from a template StateSpace when the segment is created and is stored in the segment
+    header, so a reader only needs the segment name to attach. Every (key, blade) pair of the schema maps to one
+    complex slot of a contiguous array, plain numbers use the blade None. The schema also records whether a slot held
+    a bool, int, float or complex so read gives back the same types.
+
+    Segment layout: [sequence uint64][schema length uint64][schema json][padding][complex128 values]
+
+    The writer makes the sequence number odd while writing and even once done, readers retry until they see the same
+    even sequence number before and after copying the values (no torn reads).
+    """
+    _header_size = 16
+
+    def __init__(self, name: str = None, template: StateSpace = None):
+        if template is not None:
+            self.schema = self._build_schema(template)
+            schema_bytes = json.dumps(self.schema).encode('utf-8')
+            data_offset = self._align(self._header_size + len(schema_bytes))
+            self._shm = shared_memory.SharedMemory(name=name, create=True,
+                                                   size=data_offset + 16 * max(len(self.schema), 1))
+            self._owner = True
+            self._header = np.ndarray((2,), dtype=np.uint64, buffer=self._shm.buf)
+            self._header[0] = 0
+            self._header[1] = len(schema_bytes)
+            self._shm.buf[self._header_size:self._header_size + len(schema_bytes)] = schema_bytes
+        elif name is not None:
+            self._shm = self._attach(name)
+            self._owner = False
+            self._header = np.ndarray((2,), dtype=np.uint64, buffer=self._shm.buf)
+            schema_len = int(self._header[1])
+            schema_bytes = bytes(self._shm.buf[self._header_size:self._header_size + schema_len])
+            self.schema = [(ky, blade, kind) for ky, blade, kind in json.loads(schema_bytes.decode('utf-8'))]
+            data_offset = self._align(self._header_size + schema_len)
+        else:
+            raise ValueError('Either a segment name or a template StateSpace must be given.')
+
+        self._data_offset = data_offset
+        self._data = np.ndarray((len(self.schema),), dtype=np.complex128, buffer=self._shm.buf, offset=data_offset)
+        self._slots = {(ky, blade): ind for ind, (ky, blade, _) in enumerate(self.schema)}
+        self._views = []
+        return
+
+    @staticmethod
+    def _attach(name: str) -> shared_memory.SharedMemory:
+        """
+        Attach to an existing segment without registering it with the resource tracker. The tracker is shared with
+        the writer in multiprocessing children, and a registered reader would unlink the segment when it exits.
+        """
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, create=False, track=False)
+
+        register = resource_tracker.register
+
+        def skip_shared_memory(rsc_name, rtype):
+            if rtype != 'shared_memory':
+                register(rsc_name, rtype)
+
+        resource_tracker.register = skip_shared_memory
+        try:
+            return shared_memory.SharedMemory(name=name, create=False)
+        finally:
+            resource_tracker.register = register
+
+    @staticmethod
+    def _align(size: int) -> int:
+        return (size + 15) // 16 * 16
+
+    @staticmethod
+    def _check_schema_entry(ky, blade, val) -> None:
+        """
+        Keys and blades are stored as json in the header, so only json scalars survive the round trip.
+        """
+        for name in (ky, blade):
+            if name is not None and not isinstance(name, (str, int, float)):
+                raise TypeError(f'Key {name!r} of type {name.__class__.__name__} cannot be shared, '
+                                f'use a str, int or float key.')
+        if not isinstance(val, (numbers.Number,)):
+            raise TypeError(f'Value of {ky!r} of type {val.__class__.__name__} cannot be shared, '
+                            f'only numbers and Geo values are supported.')
+        return
+
+    @staticmethod
+    def _kind(val) -> str:
+        if isinstance(val, (bool, np.bool_)):
+            return 'bool'
+        if isinstance(val, (numbers.Integral,)):
+            return 'int'
+        if isinstance(val, (numbers.Real,)):
+            return 'float'
+        return 'complex'
+
+    @staticmethod
+    def _restore(val: complex, kind: str):
+        if kind == 'bool':
+            return bool(val.real)
+        if kind == 'int':
+            return int(val.real)
+        if kind == 'float' and val.imag == 0:
+            return float(val.real)
+        return complex(val)
+
+    @classmethod
+    def _build_schema(cls, template: StateSpace) -> list:
+        schema = []
+        for ky, val in template.items():
+            if isinstance(val, (Geo, dict)):
+                for blade, blade_val in val.items():
+                    cls._check_schema_entry(ky, blade, blade_val)
+                    schema.append((ky, blade, cls._kind(blade_val)))
+            else:
+                cls._check_schema_entry(ky, None, val)
+                schema.append((ky, None, cls._kind(val)))
+        return schema
+
+    def _slot(self, ky, blade) -> int:
+        if (ky, blade) not in self._slots:
+            name = repr(ky) if blade is None else f'{ky!r}, blade {blade!r}'
+            raise KeyError(f'{name} is not part of the schema of {self.name}.')
+        return self._slots[(ky, blade)]
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def sequence(self) -> int:
+        return int(self._header[0])
+
+    # ---- writer side -----
+    def write(self, src: Union[dict, StateSpace]) -> None:
+        """
+        Copy the values of the source into the segment. Keys or blades outside the schema raise a KeyError,
+        schema entries missing from the source are set to zero.
+        :param src:
+        :return:
+        """
+        values = np.zeros(len(self.schema), dtype=np.complex128)
+        for ky, val in src.items():
+            if isinstance(val, (Geo, dict)):
+                for blade, blade_val in val.items():
+                    values[self._slot(ky, blade)] = blade_val
+            else:
+                values[self._slot(ky, None)] = val
+
+        self._header[0] += 1
+        self._data[:] = values
+        self._header[0] += 1
+        return
+
+    # ---- reader side -----
+    def view(self) -> np.ndarray:
+        """
+        Zero-copy, read-only view of the value slots ordered as the schema.
+        Compare self.sequence before and after using it to detect a concurrent write.
+        The view keeps its own export of the segment buffer, close refuses to unmap the segment while it is alive.
+        :return:
+        """
+        data_buf = self._shm.buf[self._data_offset:self._data_offset + self._data.nbytes]
+        data_view = np.frombuffer(data_buf, dtype=np.complex128)
+        data_view.flags.writeable = False
+        self._views = [ref for ref in self._views if ref() is not None] + [weakref.ref(data_view)]
+        return data_view
+
+    def read_values(self, timeout: float = 1.0) -> (np.ndarray, int):
+        """
+        Copy a consistent snapshot of the value slots.
+        :param timeout: seconds to keep retrying while the writer is busy.
+        :return: values ordered as the schema and their sequence number
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            seq_start = int(self._header[0])
+            if not seq_start % 2:
+                values = self._data.copy()
+                if int(self._header[0]) == seq_start:
+                    return values, seq_start
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f'No consistent snapshot of {self.name} within {timeout} s.')
+
+    def read(self, timeout: float = 1.0) -> StateSpace:
+        """
+        Rebuild a StateSpace from a consistent snapshot of the segment.
+        :param timeout: seconds to keep retrying while the writer is busy.
+        :return:
+        """
+        values, _ = self.read_values(timeout=timeout)
+        blades = {}
+        rslt = StateSpace()
+        for (ky, blade, kind), val in zip(self.schema, values.tolist()):
+            if blade is None:
+                rslt[ky] = self._restore(val, kind)
+            else:
+                blades.setdefault(ky, {})[blade] = self._restore(val, kind)
+        for ky, val in blades.items():
+            rslt[ky] = Geo(val)
+        return rslt
+
+    # ---- cleanup -----
+    def close(self) -> None:
+        alive = sum(ref() is not None for ref in self._views)
+        if alive:
+            raise BufferError(f'{alive} view(s) of {self.name} are still in use, delete them before closing.')
+        self._header = None
+        self._data = None
+        self._shm.close()
+        return
+
+    def unlink(self) -> None:
+        if self._owner:
+            self._shm.unlink()
+        return
+
+
 # other stuff -----------------------------------
 def array_to_dict(arr):
     try: